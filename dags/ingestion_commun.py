@@ -0,0 +1,339 @@
+"""
+Fonctions partagées par main.py et dags/ingestion_dag.py: budget mémoire,
+lecture du CSV par morceaux et insertion idempotente d'un morceau.
+
+pandas est importé dans les fonctions qui l'utilisent: ce module est chargé
+à chaque parsing du fichier de l'orchestrateur et doit rester léger.
+"""
+
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# BUDGET MÉMOIRE
+# =============================================================================
+
+# Lignes lues pour mesurer les octets par ligne avant de dimensionner les morceaux
+LIGNES_SONDE = 10
+# Lignes utilisées pour estimer la taille du JSON XCom
+LIGNES_ECHANTILLON = 1000
+# Copies simultanées d'un morceau en lecture: brut, conversion sale_date, copie filtrée
+FACTEUR_LECTURE = 3
+# Copies simultanées d'un morceau en écriture: projections par table, fusion des totaux
+FACTEUR_TRANSFORMATION = 2
+# Copies simultanées du JSON XCom: chaîne produite par to_json, sérialisation XCom
+FACTEUR_XCOM = 2
+# Pic mémoire du décodage JSON XCom (objets intermédiaires de read_json, dataframe
+# final, copie texte de sale_date) rapporté au dataframe final: ~6.6 mesuré
+FACTEUR_DECODAGE_JSON = 7
+# Part de la place disponible visée par chaque morceau: la marge absorbe des
+# lignes plus larges que celles déjà mesurées
+FRACTION_CIBLE = 0.5
+
+UNITES_MEMOIRE = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+class BudgetMemoireDepasse(Exception):
+    """Le traitement ne peut pas tenir dans le budget mémoire demandé"""
+
+def parser_budget_memoire(valeur):
+    """Convertir un budget mémoire ('512M', '2G', '100000') en octets"""
+    correspondance = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)I?[BO]?\s*', valeur.upper())
+    octets = 0
+    if correspondance:
+        octets = int(float(correspondance.group(1)) * UNITES_MEMOIRE[correspondance.group(2)])
+    if octets < 1:
+        raise ValueError(
+            f"Budget mémoire invalide: {valeur}. Attendu: nombre d'octets ou suffixe K/M/G (ex: 512M)"
+        )
+    return octets
+
+def formater_octets(octets):
+    """Formater un nombre d'octets dans l'unité la plus lisible pour les messages"""
+    for unite, facteur in (('Go', 1024 ** 3), ('Mo', 1024 ** 2), ('Ko', 1024)):
+        if octets >= facteur:
+            return f"{octets / facteur:.1f} {unite}"
+    return f"{int(octets)} octets"
+
+def mesurer_octets_par_ligne(df):
+    """Mesurer l'occupation mémoire réelle d'une ligne du dataframe"""
+    if len(df) == 0:
+        return 0
+    return math.ceil(df.memory_usage(deep=True).sum() / len(df))
+
+def calculer_taille_chunk(octets_disponibles, octets_par_ligne, facteur):
+    """
+    Nombre de lignes par morceau pour que facteur copies du morceau occupent
+    FRACTION_CIBLE des octets disponibles. Lève BudgetMemoireDepasse seulement
+    si une ligne ne tient pas dans la totalité des octets disponibles
+    """
+    octets_necessaires = octets_par_ligne * facteur
+    if octets_disponibles < octets_necessaires:
+        raise BudgetMemoireDepasse(
+            f"{formater_octets(max(octets_disponibles, 0))} disponibles alors qu'une ligne "
+            f"nécessite ~{formater_octets(octets_necessaires)}. "
+            f"Augmentez le budget mémoire (--memory-budget / memory_budget)"
+        )
+    return max(int(octets_disponibles * FRACTION_CIBLE // octets_necessaires), 1)
+
+def filtrer_csv_par_chunks(flux, date_cible, budget_memoire):
+    """
+    Lire un CSV en flux par morceaux et ne garder que les lignes de date_cible
+    Les octets par ligne sont mesurés sur une sonde de LIGNES_SONDE lignes,
+    puis chaque morceau est dimensionné (avec la marge de FRACTION_CIBLE) pour
+    que lui-même, les lignes retenues et leur concaténation finale tiennent
+    dans le budget. Un morceau plus large que prévu relève l'estimation et
+    réduit le suivant; BudgetMemoireDepasse n'est levé que si un morceau
+    dépasse toute la place disponible ou s'il reste des lignes sans place
+    """
+    import pandas as pd
+    
+    lecteur = pd.read_csv(flux, iterator=True)
+    morceaux = []
+    octets_filtres = 0
+    octets_ligne = 0
+    taille_chunk = LIGNES_SONDE
+    nb_lignes = 0
+    
+    try:
+        while True:
+            try:
+                df = lecteur.get_chunk(taille_chunk)
+            except StopIteration:
+                break
+            if len(df) == 0:
+                break
+            nb_lignes += len(df)
+            
+            # Les lignes retenues comptent double: morceaux + concaténation finale
+            octets_disponibles = budget_memoire - 2 * octets_filtres
+            octets_morceau = df.memory_usage(deep=True).sum() * FACTEUR_LECTURE
+            if octets_morceau > octets_disponibles:
+                raise BudgetMemoireDepasse(
+                    f"morceau de {len(df)} lignes: ~{formater_octets(octets_morceau)} nécessaires, "
+                    f"{formater_octets(max(octets_disponibles, 0))} disponibles sur "
+                    f"{formater_octets(budget_memoire)}. "
+                    f"Augmentez le budget mémoire (--memory-budget / memory_budget)"
+                )
+            # Lignes plus larges que l'estimation: le prochain morceau sera plus petit
+            octets_ligne = max(octets_ligne, mesurer_octets_par_ligne(df))
+            lecteur_epuise = len(df) < taille_chunk
+            
+            # Convertir sale_date en datetime et filtrer
+            df['sale_date'] = pd.to_datetime(df['sale_date'])
+            df_morceau = df[df['sale_date'].dt.date == date_cible].copy()
+            del df
+            
+            # Un morceau sans ligne retenue n'est pas conservé: son index vide
+            # consommerait du budget à chaque lecture
+            if len(df_morceau) > 0:
+                morceaux.append(df_morceau)
+                octets_filtres += df_morceau.memory_usage(deep=True).sum()
+            del df_morceau
+            
+            if lecteur_epuise:
+                break
+            try:
+                taille_chunk = calculer_taille_chunk(
+                    budget_memoire - 2 * octets_filtres, octets_ligne, FACTEUR_LECTURE
+                )
+            except BudgetMemoireDepasse:
+                # Plus de place pour une ligne: n'échouer que s'il en reste à lire
+                try:
+                    if len(lecteur.get_chunk(1)) == 0:
+                        break
+                except StopIteration:
+                    break
+                raise
+            logger.debug(f"{nb_lignes} lignes lues, prochain morceau: {taille_chunk} lignes")
+    finally:
+        lecteur.close()
+    
+    logger.info(
+        f"Fichier lu par morceaux: {nb_lignes} lignes (~{octets_ligne} octets/ligne, "
+        f"{formater_octets(octets_filtres)} retenus sur {formater_octets(budget_memoire)})"
+    )
+    
+    if not morceaux:
+        return pd.DataFrame()
+    return pd.concat(morceaux, ignore_index=True)
+
+def calculer_taille_chunk_ecriture(df_filtre, totaux_ventes, budget_memoire):
+    """
+    Nombre de lignes par morceau d'écriture: la journée filtrée et les totaux
+    par vente restent en mémoire, chaque morceau est projeté sur les 4 tables
+    """
+    if budget_memoire is None:
+        return max(len(df_filtre), 1)
+    octets_occupes = (df_filtre.memory_usage(deep=True).sum()
+                      + totaux_ventes.memory_usage(deep=True).sum())
+    taille_chunk = calculer_taille_chunk(
+        budget_memoire - octets_occupes,
+        mesurer_octets_par_ligne(df_filtre),
+        FACTEUR_TRANSFORMATION
+    )
+    logger.info(f"Écriture par morceaux de {taille_chunk} lignes")
+    return taille_chunk
+
+# =============================================================================
+# INSERTION POSTGRESQL
+# =============================================================================
+
+def inserer_morceau(conn, cursor, morceau, totaux_ventes):
+    """
+    Insérer un morceau des données filtrées dans les 4 tables (idempotente)
+    totaux_ventes = total_amount par sale_id calculé sur la journée complète
+    """
+    
+    # =====================================================================
+    # TABLE 1: CUSTOMERS (idempotente)
+    # =====================================================================
+    logger.info("Insertion dans CUSTOMERS...")
+    clients_df = morceau[['customer_id', 'first_name', 'last_name', 'email', 
+                            'gender', 'age_range', 'country', 'signup_date']].drop_duplicates()
+    
+    for idx, ligne in clients_df.iterrows():
+        cursor.execute("""
+            INSERT INTO customers 
+            (customer_id, first_name, last_name, email, gender, age_range, country, signup_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (customer_id) DO UPDATE SET
+                first_name = EXCLUDED.first_name,
+                last_name = EXCLUDED.last_name,
+                email = EXCLUDED.email,
+                gender = EXCLUDED.gender,
+                age_range = EXCLUDED.age_range,
+                country = EXCLUDED.country,
+                signup_date = EXCLUDED.signup_date
+        """, (
+            ligne['customer_id'],
+            ligne['first_name'],
+            ligne['last_name'],
+            ligne['email'],
+            ligne['gender'],
+            ligne['age_range'],
+            ligne['country'],
+            ligne['signup_date']
+        ))
+    
+    conn.commit()
+    logger.info(f"CUSTOMERS: {len(clients_df)} lignes traitées")
+    
+    # =====================================================================
+    # TABLE 2: PRODUCTS (idempotente)
+    # =====================================================================
+    logger.info("Insertion dans PRODUCTS...")
+    produits_df = morceau[['product_id', 'product_name', 'category', 'brand', 
+                              'color', 'size', 'catalog_price', 'cost_price']].drop_duplicates()
+    
+    for idx, ligne in produits_df.iterrows():
+        cursor.execute("""
+            INSERT INTO products 
+            (product_id, product_name, category, brand, color, size, catalog_price, cost_price)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (product_id) DO UPDATE SET
+                product_name = EXCLUDED.product_name,
+                category = EXCLUDED.category,
+                brand = EXCLUDED.brand,
+                color = EXCLUDED.color,
+                size = EXCLUDED.size,
+                catalog_price = EXCLUDED.catalog_price,
+                cost_price = EXCLUDED.cost_price
+        """, (
+            ligne['product_id'],
+            ligne['product_name'],
+            ligne['category'],
+            ligne['brand'],
+            ligne['color'],
+            ligne['size'],
+            ligne['catalog_price'],
+            ligne['cost_price']
+        ))
+    
+    conn.commit()
+    logger.info(f"PRODUCTS: {len(produits_df)} lignes traitées")
+    
+    # =====================================================================
+    # TABLE 3: SALES (idempotente)
+    # =====================================================================
+    logger.info("Insertion dans SALES...")
+    ventes_df = morceau[['sale_id', 'sale_date', 'customer_id', 
+                           'channel', 'channel_campaigns']].drop_duplicates()
+    
+    ventes_df = ventes_df.merge(totaux_ventes, on='sale_id', how='left')
+    
+    for idx, ligne in ventes_df.iterrows():
+        cursor.execute("""
+            INSERT INTO sales 
+            (sale_id, sale_date, customer_id, channel, channel_campaigns, total_amount)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (sale_id) DO UPDATE SET
+                sale_date = EXCLUDED.sale_date,
+                customer_id = EXCLUDED.customer_id,
+                channel = EXCLUDED.channel,
+                channel_campaigns = EXCLUDED.channel_campaigns,
+                total_amount = EXCLUDED.total_amount
+        """, (
+            ligne['sale_id'],
+            ligne['sale_date'],
+            ligne['customer_id'],
+            ligne['channel'],
+            ligne['channel_campaigns'],
+            ligne['total_amount']
+        ))
+    
+    conn.commit()
+    logger.info(f"SALES: {len(ventes_df)} lignes traitées")
+    
+    # =====================================================================
+    # TABLE 4: SALE_ITEMS (idempotente)
+    # =====================================================================
+    logger.info("Insertion dans SALE_ITEMS...")
+    articles_vente_df = morceau[['item_id', 'sale_id', 'product_id', 'quantity', 
+                                    'unit_price', 'original_price', 'discount_applied', 
+                                    'discount_percent', 'item_total']]
+    
+    for idx, ligne in articles_vente_df.iterrows():
+        cursor.execute("""
+            INSERT INTO sale_items 
+            (item_id, sale_id, product_id, quantity, unit_price, original_price, 
+             discount_applied, discount_percent, item_total)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (item_id) DO UPDATE SET
+                sale_id = EXCLUDED.sale_id,
+                product_id = EXCLUDED.product_id,
+                quantity = EXCLUDED.quantity,
+                unit_price = EXCLUDED.unit_price,
+                original_price = EXCLUDED.original_price,
+                discount_applied = EXCLUDED.discount_applied,
+                discount_percent = EXCLUDED.discount_percent,
+                item_total = EXCLUDED.item_total
+        """, (
+            ligne['item_id'],
+            ligne['sale_id'],
+            ligne['product_id'],
+            ligne['quantity'],
+            ligne['unit_price'],
+            ligne['original_price'],
+            ligne['discount_applied'],
+            ligne['discount_percent'],
+            ligne['item_total']
+        ))
+    
+    conn.commit()
+    logger.info(f"SALE_ITEMS: {len(articles_vente_df)} lignes traitées")
+
+def compter_lignes_par_table(df_filtre):
+    """
+    Lignes distinctes par table sur la journée complète. Les compteurs de
+    inserer_morceau sont dédupliqués par morceau seulement: un client, produit
+    ou vente présent dans plusieurs morceaux y serait compté plusieurs fois
+    """
+    return {
+        'customers': df_filtre['customer_id'].nunique(),
+        'products': df_filtre['product_id'].nunique(),
+        'sales': df_filtre['sale_id'].nunique(),
+        'sale_items': len(df_filtre)
+    }
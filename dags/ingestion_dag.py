@@ -1,14 +1,31 @@
 from datetime import datetime, timedelta
+import json
 import logging
+import math
 import os
-from io import BytesIO
-import pandas as pd
-import psycopg2
-from minio import Minio
+import re
 
 from airflow import DAG
 from airflow.operators.python import PythonOperator
-from airflow.exceptions import AirflowException
+from airflow.exceptions import AirflowException, AirflowFailException
+
+from ingestion_commun import (
+    FACTEUR_DECODAGE_JSON,
+    FACTEUR_XCOM,
+    LIGNES_ECHANTILLON,
+    BudgetMemoireDepasse,
+    calculer_taille_chunk_ecriture,
+    compter_lignes_par_table,
+    filtrer_csv_par_chunks,
+    formater_octets,
+    inserer_morceau,
+    mesurer_octets_par_ligne,
+    parser_budget_memoire,
+)
+
+# Les bibliothèques lourdes (pandas, psycopg2, minio) sont importées dans les
+# fonctions des tâches : le scheduler re-parse ce fichier toutes les quelques
+# secondes et ne doit payer que le coût d'Airflow et de la configuration.
 
 # =============================================================================
 # CONFIGURATION DU LOGGING
@@ -38,8 +55,11 @@ CONFIG_POSTGRES = {
     "database": os.getenv("POSTGRES_DB", "ecommerce_db")
 }
 
-NOM_BUCKET = "folder-source"
-CLE_FICHIER_CSV = "fashion_store_sales.csv"
+# Fichier de configuration des sources (YAML ou JSON) : un DAG par source
+FICHIER_SOURCES = os.getenv(
+    "INGESTION_SOURCES_CONFIG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources_ingestion.yaml")
+)
 
 # =============================================================================
 # PARAMÈTRES DU DAG
@@ -55,20 +75,95 @@ default_args = {
     'retry_delay': timedelta(minutes=5),
 }
 
-DAG_ID = 'ingestion_ecommerce_minio_postgres'
+SCHEDULE_PAR_DEFAUT = '0 2 * * *'
+SCHEMA_PAR_DEFAUT = 'public'
+# Budget mémoire par défaut des sources sans 'memory_budget' (ex: 512M). Une
+# valeur invalide fait échouer l'import (erreur visible dans Airflow) plutôt que
+# d'ignorer toutes les sources une à une
+BUDGET_MEMOIRE_PAR_DEFAUT = os.getenv("INGESTION_MEMORY_BUDGET")
+if BUDGET_MEMOIRE_PAR_DEFAUT is not None:
+    try:
+        BUDGET_MEMOIRE_PAR_DEFAUT = parser_budget_memoire(BUDGET_MEMOIRE_PAR_DEFAUT)
+    except ValueError as e:
+        raise ValueError(f"INGESTION_MEMORY_BUDGET invalide: {e}")
+
+# Identifiant de source (utilisé dans le dag_id) et nom de schéma PostgreSQL
+MOTIF_ID_SOURCE = re.compile(r'[A-Za-z0-9_.-]+')
+MOTIF_SCHEMA = re.compile(r'[A-Za-z_][A-Za-z0-9_]{0,62}')
 
 # =============================================================================
-# DÉFINITION DU DAG
+# CHARGEMENT DES SOURCES
 # =============================================================================
 
-dag = DAG(
-    dag_id=DAG_ID,
-    default_args=default_args,
-    description='DAG pour ingérer les données e-commerce depuis Minio vers PostgreSQL',
-    schedule_interval='0 2 * * *',
-    catchup=False,
-    tags=['e-commerce', 'data-ingestion', 'minio', 'postgres'],
-)
+def valider_source(source):
+    """
+    Valider une entrée de configuration et compléter les valeurs par défaut
+    Lève ValueError avec l'id de la source si l'entrée est invalide
+    """
+    if not isinstance(source, dict):
+        raise ValueError(f"Source invalide {source!r}: un dictionnaire est attendu")
+    
+    id_source = source.get('id')
+    manquants = [cle for cle in ('id', 'bucket', 'prefix') if not source.get(cle)]
+    if manquants:
+        raise ValueError(f"Source '{id_source}' invalide: clés manquantes {manquants}")
+    if not MOTIF_ID_SOURCE.fullmatch(str(id_source)):
+        raise ValueError(f"Source '{id_source}' invalide: id autorisé [A-Za-z0-9_.-]")
+    
+    schema = source.get('schema', SCHEMA_PAR_DEFAUT)
+    if not MOTIF_SCHEMA.fullmatch(str(schema)):
+        raise ValueError(f"Source '{id_source}' invalide: schéma '{schema}' n'est pas un identifiant PostgreSQL")
+    
+    return {
+        **source,
+        'id': str(id_source),
+        'schedule': source.get('schedule', SCHEDULE_PAR_DEFAUT),
+        'schema': schema,
+    }
+
+def valider_budget_memoire_source(source):
+    """
+    Convertir le memory_budget d'une source validée en octets (défaut:
+    INGESTION_MEMORY_BUDGET). Lève ValueError avec l'id de la source si invalide
+    """
+    budget_memoire = source.get('memory_budget')
+    if budget_memoire is None:
+        budget_memoire = BUDGET_MEMOIRE_PAR_DEFAUT
+    else:
+        try:
+            budget_memoire = parser_budget_memoire(str(budget_memoire))
+        except ValueError as e:
+            raise ValueError(f"Source '{source['id']}' invalide: {e}")
+    return {**source, 'memory_budget': budget_memoire}
+
+def charger_sources(chemin=FICHIER_SOURCES):
+    """
+    Lire la liste des sources depuis un fichier YAML ou JSON
+    Chaque source doit définir au minimum: id, bucket, prefix
+    Une entrée invalide ou un id en double est ignoré (journalisé) pour ne pas
+    faire disparaître les DAGs des autres sources
+    """
+    with open(chemin, encoding='utf-8') as fichier:
+        if chemin.endswith(('.yaml', '.yml')):
+            import yaml
+            contenu = yaml.safe_load(fichier)
+        else:
+            contenu = json.load(fichier)
+    
+    sources = []
+    ids_vus = set()
+    for source in (contenu or {}).get('sources') or []:
+        try:
+            source = valider_budget_memoire_source(valider_source(source))
+        except ValueError as e:
+            logger.error(f"{e} - source ignorée")
+            continue
+        if source['id'] in ids_vus:
+            logger.error(f"Source '{source['id']}' déclarée plusieurs fois - doublon ignoré")
+            continue
+        ids_vus.add(source['id'])
+        sources.append(source)
+    return sources
 
 # =============================================================================
 # FONCTIONS PYTHON
@@ -83,11 +178,16 @@ def valider_date(date_str):
         logger.error(f"Format de date invalide: {date_str}. Attendu: YYYYMMDD")
         raise AirflowException(f"Format de date invalide: {date_str}")
 
-def telecharger_et_filtrer_depuis_minio(ds, **context):
+def telecharger_et_filtrer_depuis_minio(ds, bucket, prefix, budget_memoire=None, **context):
     """
-    Télécharger le fichier CSV depuis Minio et filtrer par date
+    Télécharger les fichiers CSV du préfixe depuis Minio et filtrer par date
     ds = date de la tâche Airflow au format YYYY-MM-DD
+    bucket, prefix = emplacement des fichiers de la source
+    budget_memoire = octets maximum du traitement (lecture en flux par morceaux)
     """
+    from io import BytesIO
+    import pandas as pd
+    from minio import Minio
     
     # Convertir la date Airflow (YYYY-MM-DD) en format attendu (YYYYMMDD)
     date_str = ds.replace('-', '')
@@ -107,49 +207,102 @@ def telecharger_et_filtrer_depuis_minio(ds, **context):
             secure=False
         )
         # Vérifier si le bucket existe
-        if not client_minio.bucket_exists(NOM_BUCKET):
-            logger.error(f"Le bucket '{NOM_BUCKET}' n'existe pas!")
-            logger.info(f"Création du bucket '{NOM_BUCKET}'...")
-            client_minio.make_bucket(NOM_BUCKET)
-            logger.warning(f"Bucket créé mais vide. Veuillez uploader le fichier {CLE_FICHIER_CSV}")
+        if not client_minio.bucket_exists(bucket):
+            logger.error(f"Le bucket '{bucket}' n'existe pas!")
+            logger.info(f"Création du bucket '{bucket}'...")
+            client_minio.make_bucket(bucket)
+            logger.warning(f"Bucket créé mais vide. Veuillez uploader les fichiers sous '{prefix}'")
             return None
         
-        # Télécharger le fichier depuis Minio
-        logger.info(f"Téléchargement du fichier {CLE_FICHIER_CSV} depuis le bucket {NOM_BUCKET}...")
-        reponse = client_minio.get_object(NOM_BUCKET, CLE_FICHIER_CSV)
-        contenu_csv = reponse.read()
-        
-        # Lire le CSV depuis le contenu en mémoire
-        df = pd.read_csv(BytesIO(contenu_csv))
-        logger.info(f"Fichier lu: {len(df)} lignes")
+        cles_csv = [
+            objet.object_name
+            for objet in client_minio.list_objects(bucket, prefix=prefix, recursive=True)
+            if objet.object_name.endswith('.csv')
+        ]
+        if not cles_csv:
+            logger.warning(f"Aucun fichier CSV sous '{prefix}' dans le bucket {bucket}")
+            return None
         
-        # Convertir sale_date en datetime et filtrer
-        df['sale_date'] = pd.to_datetime(df['sale_date'])
         date_cible = datetime.strptime(date_str, "%Y%m%d").date()
+        morceaux = []
+        octets_retenus = 0
+        
+        for cle in cles_csv:
+            # Télécharger le fichier depuis Minio
+            logger.info(f"Téléchargement du fichier {cle} depuis le bucket {bucket}...")
+            reponse = client_minio.get_object(bucket, cle)
+            try:
+                if budget_memoire is not None:
+                    # Lire le CSV en flux; les lignes déjà retenues des fichiers
+                    # précédents (et leur concaténation) sont déduites du budget
+                    df_fichier = filtrer_csv_par_chunks(
+                        reponse, date_cible, budget_memoire - 2 * octets_retenus
+                    )
+                    morceaux.append(df_fichier)
+                    octets_retenus += df_fichier.memory_usage(deep=True).sum()
+                else:
+                    contenu_csv = reponse.read()
+            finally:
+                reponse.close()
+                reponse.release_conn()
+            
+            if budget_memoire is None:
+                # Lire le CSV depuis le contenu en mémoire
+                df = pd.read_csv(BytesIO(contenu_csv))
+                logger.info(f"Fichier {cle} lu: {len(df)} lignes")
+                
+                # Convertir sale_date en datetime et filtrer
+                df['sale_date'] = pd.to_datetime(df['sale_date'])
+                morceaux.append(df[df['sale_date'].dt.date == date_cible].copy())
         
-        df_filtre = df[df['sale_date'].dt.date == date_cible].copy()
+        df_filtre = pd.concat(morceaux, ignore_index=True)
+        del morceaux
         logger.info(f"Filtrage par date {date_str}: {len(df_filtre)} lignes trouvées")
         
         if len(df_filtre) == 0:
             logger.warning(f"Aucune donnée pour la date {date_str}")
             return None
         
+        if budget_memoire is not None:
+            # Estimer la taille du JSON XCom sur un échantillon avant de le produire
+            echantillon = df_filtre.head(LIGNES_ECHANTILLON)
+            octets_json = math.ceil(len(echantillon.to_json()) / len(echantillon) * len(df_filtre))
+            octets_necessaires = octets_retenus + FACTEUR_XCOM * octets_json
+            if octets_necessaires > budget_memoire:
+                raise BudgetMemoireDepasse(
+                    f"{len(df_filtre)} lignes retenues: ~{formater_octets(octets_necessaires)} "
+                    f"nécessaires pour les transmettre via XCom, budget de "
+                    f"{formater_octets(budget_memoire)}. Augmentez memory_budget"
+                )
+        
         # Sauvegarder le dataframe dans XCom pour la tâche suivante
         context['task_instance'].xcom_push(key='df_filtre', value=df_filtre.to_json())
         logger.info("Données filtrées sauvegardées dans XCom")
         
         return {
             'nb_lignes': len(df_filtre),
+            'octets_par_ligne': mesurer_octets_par_ligne(df_filtre),
             'date': date_str,
             'status': 'success'
         }
         
+    except BudgetMemoireDepasse as e:
+        logger.error(f"Budget mémoire insuffisant pour la date {date_str}: {e}")
+        raise AirflowFailException(f"Budget mémoire insuffisant: {str(e)}")
+        
     except Exception as e:
         logger.error(f"Erreur lors du téléchargement/filtrage: {e}")
         raise AirflowException(f"Erreur Minio: {str(e)}")
 
-def inserer_dans_postgresql(ds, **context):
-    """Insérer les données filtrées dans PostgreSQL (idempotente)"""
+def inserer_dans_postgresql(ds, schema, budget_memoire=None, **context):
+    """
+    Insérer les données filtrées dans PostgreSQL (idempotente)
+    schema = schéma PostgreSQL cible de la source
+    budget_memoire = octets maximum du traitement (écriture par morceaux)
+    """
+    from io import StringIO
+    import pandas as pd
+    import psycopg2
     
     # Récupérer le dataframe depuis XCom
     df_json = context['task_instance'].xcom_pull(
@@ -161,7 +314,23 @@ def inserer_dans_postgresql(ds, **context):
         logger.warning("Aucune donnée à insérer")
         return {'status': 'no_data'}
     
-    df_filtre = pd.read_json(BytesIO(df_json.encode()))
+    if budget_memoire is not None:
+        # Estimer le pic du décodage (JSON + objets intermédiaires + dataframe
+        # reconstruit + copie de sale_date) avant de décoder
+        resultat = context['task_instance'].xcom_pull(task_ids='telecharger_et_filtrer_depuis_minio')
+        octets_dataframe = resultat['nb_lignes'] * resultat['octets_par_ligne']
+        octets_necessaires = len(df_json) + FACTEUR_DECODAGE_JSON * octets_dataframe
+        if octets_necessaires > budget_memoire:
+            message = (
+                f"{resultat['nb_lignes']} lignes: ~{formater_octets(octets_necessaires)} nécessaires "
+                f"pour décoder le JSON XCom, budget de {formater_octets(budget_memoire)}. "
+                f"Augmentez memory_budget"
+            )
+            logger.error(f"Budget mémoire insuffisant pour la lecture XCom: {message}")
+            raise AirflowFailException(f"Budget mémoire insuffisant: {message}")
+    
+    df_filtre = pd.read_json(StringIO(df_json))
+    del df_json
     df_filtre['sale_date'] = pd.to_datetime(df_filtre['sale_date']).dt.strftime('%Y-%m-%d')
     logger.info(f"Récupération des données: {len(df_filtre)} lignes")
     
@@ -169,161 +338,35 @@ def inserer_dans_postgresql(ds, **context):
     cursor = None
     
     try:
-        conn = psycopg2.connect(**CONFIG_POSTGRES)
-        cursor = conn.cursor()
-        logger.info("Connexion à PostgreSQL établie")
-        
-        # =====================================================================
-        # TABLE 1: CUSTOMERS (idempotente)
-        # =====================================================================
-        logger.info("Insertion dans CUSTOMERS...")
-        clients_df = df_filtre[['customer_id', 'first_name', 'last_name', 'email', 
-                                'gender', 'age_range', 'country', 'signup_date']].drop_duplicates()
-        
-        for idx, ligne in clients_df.iterrows():
-            cursor.execute("""
-                INSERT INTO customers 
-                (customer_id, first_name, last_name, email, gender, age_range, country, signup_date)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (customer_id) DO UPDATE SET
-                    first_name = EXCLUDED.first_name,
-                    last_name = EXCLUDED.last_name,
-                    email = EXCLUDED.email,
-                    gender = EXCLUDED.gender,
-                    age_range = EXCLUDED.age_range,
-                    country = EXCLUDED.country,
-                    signup_date = EXCLUDED.signup_date
-            """, (
-                ligne['customer_id'],
-                ligne['first_name'],
-                ligne['last_name'],
-                ligne['email'],
-                ligne['gender'],
-                ligne['age_range'],
-                ligne['country'],
-                ligne['signup_date']
-            ))
-        
-        conn.commit()
-        logger.info(f"CUSTOMERS: {len(clients_df)} lignes traitées")
-        
-        # =====================================================================
-        # TABLE 2: PRODUCTS (idempotente)
-        # =====================================================================
-        logger.info("Insertion dans PRODUCTS...")
-        produits_df = df_filtre[['product_id', 'product_name', 'category', 'brand', 
-                                  'color', 'size', 'catalog_price', 'cost_price']].drop_duplicates()
-        
-        for idx, ligne in produits_df.iterrows():
-            cursor.execute("""
-                INSERT INTO products 
-                (product_id, product_name, category, brand, color, size, catalog_price, cost_price)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (product_id) DO UPDATE SET
-                    product_name = EXCLUDED.product_name,
-                    category = EXCLUDED.category,
-                    brand = EXCLUDED.brand,
-                    color = EXCLUDED.color,
-                    size = EXCLUDED.size,
-                    catalog_price = EXCLUDED.catalog_price,
-                    cost_price = EXCLUDED.cost_price
-            """, (
-                ligne['product_id'],
-                ligne['product_name'],
-                ligne['category'],
-                ligne['brand'],
-                ligne['color'],
-                ligne['size'],
-                ligne['catalog_price'],
-                ligne['cost_price']
-            ))
-        
-        conn.commit()
-        logger.info(f"PRODUCTS: {len(produits_df)} lignes traitées")
-        
-        # =====================================================================
-        # TABLE 3: SALES (idempotente)
-        # =====================================================================
-        logger.info("Insertion dans SALES...")
-        ventes_df = df_filtre[['sale_id', 'sale_date', 'customer_id', 
-                               'channel', 'channel_campaigns']].drop_duplicates()
-        
-        # Recalculer total_amount
+        # Recalculer total_amount sur la journée complète: une vente peut
+        # être répartie sur plusieurs morceaux
         totaux_ventes = df_filtre.groupby('sale_id')['item_total'].sum().reset_index()
         totaux_ventes.columns = ['sale_id', 'total_amount']
-        ventes_df = ventes_df.merge(totaux_ventes, on='sale_id', how='left')
         
-        for idx, ligne in ventes_df.iterrows():
-            cursor.execute("""
-                INSERT INTO sales 
-                (sale_id, sale_date, customer_id, channel, channel_campaigns, total_amount)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (sale_id) DO UPDATE SET
-                    sale_date = EXCLUDED.sale_date,
-                    customer_id = EXCLUDED.customer_id,
-                    channel = EXCLUDED.channel,
-                    channel_campaigns = EXCLUDED.channel_campaigns,
-                    total_amount = EXCLUDED.total_amount
-            """, (
-                ligne['sale_id'],
-                ligne['sale_date'],
-                ligne['customer_id'],
-                ligne['channel'],
-                ligne['channel_campaigns'],
-                ligne['total_amount']
-            ))
+        taille_chunk = calculer_taille_chunk_ecriture(df_filtre, totaux_ventes, budget_memoire)
         
-        conn.commit()
-        logger.info(f"SALES: {len(ventes_df)} lignes traitées")
+        conn = psycopg2.connect(**CONFIG_POSTGRES, options=f"-c search_path={schema}")
+        cursor = conn.cursor()
+        logger.info(f"Connexion à PostgreSQL établie (schéma: {schema})")
         
-        # =====================================================================
-        # TABLE 4: SALE_ITEMS (idempotente)
-        # =====================================================================
-        logger.info("Insertion dans SALE_ITEMS...")
-        articles_vente_df = df_filtre[['item_id', 'sale_id', 'product_id', 'quantity', 
-                                        'unit_price', 'original_price', 'discount_applied', 
-                                        'discount_percent', 'item_total']]
+        for debut in range(0, len(df_filtre), taille_chunk):
+            inserer_morceau(conn, cursor, df_filtre.iloc[debut:debut + taille_chunk], totaux_ventes)
         
-        for idx, ligne in articles_vente_df.iterrows():
-            cursor.execute("""
-                INSERT INTO sale_items 
-                (item_id, sale_id, product_id, quantity, unit_price, original_price, 
-                 discount_applied, discount_percent, item_total)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (item_id) DO UPDATE SET
-                    sale_id = EXCLUDED.sale_id,
-                    product_id = EXCLUDED.product_id,
-                    quantity = EXCLUDED.quantity,
-                    unit_price = EXCLUDED.unit_price,
-                    original_price = EXCLUDED.original_price,
-                    discount_applied = EXCLUDED.discount_applied,
-                    discount_percent = EXCLUDED.discount_percent,
-                    item_total = EXCLUDED.item_total
-            """, (
-                ligne['item_id'],
-                ligne['sale_id'],
-                ligne['product_id'],
-                ligne['quantity'],
-                ligne['unit_price'],
-                ligne['original_price'],
-                ligne['discount_applied'],
-                ligne['discount_percent'],
-                ligne['item_total']
-            ))
+        lignes_traitees = compter_lignes_par_table(df_filtre)
         
-        conn.commit()
-        logger.info(f"SALE_ITEMS: {len(articles_vente_df)} lignes traitées")
+        logger.info(f"Lignes traitées par table: {lignes_traitees}")
         
         logger.info("Ingestion terminée avec succès!")
         
         return {
-            'customers': len(clients_df),
-            'products': len(produits_df),
-            'sales': len(ventes_df),
-            'sale_items': len(articles_vente_df),
+            **lignes_traitees,
             'status': 'success'
         }
         
+    except BudgetMemoireDepasse as e:
+        logger.error(f"Budget mémoire insuffisant pour l'écriture: {e}")
+        raise AirflowFailException(f"Budget mémoire insuffisant: {str(e)}")
+        
     except psycopg2.Error as e:
         logger.error(f"Erreur PostgreSQL: {e}")
         if conn:
@@ -343,25 +386,54 @@ def inserer_dans_postgresql(ds, **context):
             conn.close()
 
 # =============================================================================
-# DÉFINITION DES TÂCHES
+# FABRIQUE DE DAGS
 # =============================================================================
 
-task_telecharger = PythonOperator(
-    task_id='telecharger_et_filtrer_depuis_minio',
-    python_callable=telecharger_et_filtrer_depuis_minio,
-    provide_context=True,
-    dag=dag,
-)
-
-task_inserer = PythonOperator(
-    task_id='inserer_dans_postgresql',
-    python_callable=inserer_dans_postgresql,
-    provide_context=True,
-    dag=dag,
-)
+def creer_dag(source):
+    """
+    Construire le DAG d'ingestion d'une source (Minio → PostgreSQL)
+    source = entrée validée par valider_source
+    """
+    dag = DAG(
+        dag_id=f"ingestion_{source['id']}_minio_postgres",
+        default_args=default_args,
+        description=f"DAG pour ingérer la source '{source['id']}' depuis Minio vers PostgreSQL",
+        schedule_interval=source['schedule'],
+        catchup=False,
+        tags=['e-commerce', 'data-ingestion', 'minio', 'postgres', source['id']],
+    )
+    
+    task_telecharger = PythonOperator(
+        task_id='telecharger_et_filtrer_depuis_minio',
+        python_callable=telecharger_et_filtrer_depuis_minio,
+        op_kwargs={
+            'bucket': source['bucket'],
+            'prefix': source['prefix'],
+            'budget_memoire': source['memory_budget'],
+        },
+        provide_context=True,
+        dag=dag,
+    )
+    
+    task_inserer = PythonOperator(
+        task_id='inserer_dans_postgresql',
+        python_callable=inserer_dans_postgresql,
+        op_kwargs={
+            'schema': source['schema'],
+            'budget_memoire': source['memory_budget'],
+        },
+        provide_context=True,
+        dag=dag,
+    )
+    
+    # Dépendances
+    task_telecharger >> task_inserer
+    
+    return dag
 
 # =============================================================================
-# DÉPENDANCES
+# ENREGISTREMENT DES DAGS
 # =============================================================================
 
-task_telecharger >> task_inserer
\ No newline at end of file
+# Airflow découvre les DAGs présents dans l'espace de noms global du module
+globals().update({dag.dag_id: dag for dag in map(creer_dag, charger_sources())})
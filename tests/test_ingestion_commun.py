@@ -0,0 +1,197 @@
+"""Budget mémoire et lecture par morceaux (dags/ingestion_commun.py)"""
+
+import os
+import sys
+from datetime import date
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RACINE, "dags"))
+
+import ingestion_commun  # noqa: E402
+from ingestion_commun import (  # noqa: E402
+    FACTEUR_LECTURE,
+    FRACTION_CIBLE,
+    LIGNES_SONDE,
+    BudgetMemoireDepasse,
+    calculer_taille_chunk,
+    calculer_taille_chunk_ecriture,
+    filtrer_csv_par_chunks,
+    parser_budget_memoire,
+)
+
+FICHIER_CSV = os.path.join(RACINE, "fashion_store_sales.csv")
+DATE_CIBLE = date(2025, 6, 16)
+
+def filtrer_sans_budget(flux=FICHIER_CSV):
+    """Chemin historique: fichier complet en mémoire puis filtrage"""
+    df = pd.read_csv(flux)
+    df['sale_date'] = pd.to_datetime(df['sale_date'])
+    return df[df['sale_date'].dt.date == DATE_CIBLE].reset_index(drop=True)
+
+@pytest.fixture(scope="module")
+def csv_lignes_elargies(tmp_path_factory):
+    """20 copies du jeu de données, channel_campaigns élargi de 200 caractères à mi-fichier"""
+    df = pd.concat([pd.read_csv(FICHIER_CSV)] * 20, ignore_index=True)
+    milieu = len(df) // 2
+    df.loc[milieu:, 'channel_campaigns'] = df.loc[milieu:, 'channel_campaigns'] + 'x' * 200
+    chemin = tmp_path_factory.mktemp("csv") / "lignes_elargies.csv"
+    df.to_csv(chemin, index=False)
+    return chemin
+
+@pytest.fixture
+def morceaux_lus(monkeypatch):
+    """Enregistrer l'empreinte (x FACTEUR_LECTURE) de chaque morceau lu"""
+    empreintes = []
+    read_csv = pd.read_csv
+
+    def read_csv_espion(*args, **kwargs):
+        lecteur = read_csv(*args, **kwargs)
+        if not kwargs.get("iterator"):
+            return lecteur
+        get_chunk = lecteur.get_chunk
+
+        def get_chunk_espion(taille):
+            df = get_chunk(taille)
+            empreintes.append((len(df), df.memory_usage(deep=True).sum() * FACTEUR_LECTURE))
+            return df
+
+        lecteur.get_chunk = get_chunk_espion
+        return lecteur
+
+    monkeypatch.setattr(pd, "read_csv", read_csv_espion)
+    return empreintes
+
+# =============================================================================
+# parser_budget_memoire
+# =============================================================================
+
+@pytest.mark.parametrize("valeur, octets", [
+    ("1", 1),
+    ("100000", 100000),
+    ("512K", 512 * 1024),
+    ("512M", 512 * 1024 ** 2),
+    ("2G", 2 * 1024 ** 3),
+    ("1.5g", int(1.5 * 1024 ** 3)),
+    ("2GiB", 2 * 1024 ** 3),
+    ("256Mo", 256 * 1024 ** 2),
+])
+def test_parser_budget_memoire(valeur, octets):
+    assert parser_budget_memoire(valeur) == octets
+
+@pytest.mark.parametrize("valeur", ["", "abc", "0", "0M", "-1", "0.5", "0.0001K", "12T"])
+def test_parser_budget_memoire_invalide(valeur):
+    with pytest.raises(ValueError):
+        parser_budget_memoire(valeur)
+
+# =============================================================================
+# calculer_taille_chunk
+# =============================================================================
+
+def test_calculer_taille_chunk_garde_une_marge():
+    taille = calculer_taille_chunk(100_000, 1_000, 3)
+    assert taille == 16
+    assert taille * 1_000 * 3 <= 100_000 * FRACTION_CIBLE
+
+def test_calculer_taille_chunk_une_ligne_si_elle_tient_dans_toute_la_place():
+    assert calculer_taille_chunk(3_000, 1_000, 3) == 1
+
+@pytest.mark.parametrize("octets_disponibles", [2_999, 0, -50_000])
+def test_calculer_taille_chunk_impossible(octets_disponibles):
+    with pytest.raises(BudgetMemoireDepasse):
+        calculer_taille_chunk(octets_disponibles, 1_000, 3)
+
+def test_calculer_taille_chunk_ecriture():
+    df_filtre = filtrer_sans_budget()
+    totaux_ventes = df_filtre.groupby('sale_id')['item_total'].sum().reset_index()
+
+    assert calculer_taille_chunk_ecriture(df_filtre, totaux_ventes, None) == len(df_filtre)
+    assert 1 <= calculer_taille_chunk_ecriture(df_filtre, totaux_ventes, 150 * 1024) < len(df_filtre)
+    with pytest.raises(BudgetMemoireDepasse):
+        calculer_taille_chunk_ecriture(df_filtre, totaux_ventes, 10 * 1024)
+
+# =============================================================================
+# filtrer_csv_par_chunks
+# =============================================================================
+
+@pytest.mark.parametrize("budget", ["200K", "1M", "50M"])
+def test_filtrer_csv_identique_au_chemin_sans_budget(budget):
+    with open(FICHIER_CSV, "rb") as flux:
+        df_filtre = filtrer_csv_par_chunks(flux, DATE_CIBLE, parser_budget_memoire(budget))
+
+    pd.testing.assert_frame_equal(df_filtre, filtrer_sans_budget())
+
+@pytest.mark.parametrize("budget", ["140K", "160K", "190K", "200K", "1M"])
+def test_filtrer_csv_budget_suffisant_ne_leve_pas(budget):
+    # Régression: des morceaux dimensionnés à 100% de la place échouaient à 190K
+    with open(FICHIER_CSV, "rb") as flux:
+        df_filtre = filtrer_csv_par_chunks(flux, DATE_CIBLE, parser_budget_memoire(budget))
+
+    assert len(df_filtre) == len(filtrer_sans_budget())
+
+def test_filtrer_csv_morceaux_adaptes_au_budget(morceaux_lus):
+    budget_memoire = parser_budget_memoire("1M")
+    with open(FICHIER_CSV, "rb") as flux:
+        filtrer_csv_par_chunks(flux, DATE_CIBLE, budget_memoire)
+
+    tailles = [lignes for lignes, _ in morceaux_lus]
+    assert tailles[0] == LIGNES_SONDE
+    # Après la sonde, les morceaux grossissent jusqu'à la part visée du budget
+    assert max(tailles) > 10 * LIGNES_SONDE
+    assert max(empreinte for _, empreinte in morceaux_lus[1:]) <= budget_memoire * FRACTION_CIBLE * 1.1
+
+@pytest.mark.parametrize("budget", ["4M", "16M", "64M"])
+def test_filtrer_csv_lignes_elargies_en_cours_de_fichier(csv_lignes_elargies, morceaux_lus, budget):
+    # Régression: des lignes plus larges que l'estimation faisaient échouer un budget suffisant
+    with open(csv_lignes_elargies, "rb") as flux:
+        df_filtre = filtrer_csv_par_chunks(flux, DATE_CIBLE, parser_budget_memoire(budget))
+
+    pd.testing.assert_frame_equal(df_filtre, filtrer_sans_budget(csv_lignes_elargies))
+    # Les morceaux lus après l'élargissement sont plus petits qu'avant
+    milieu = sum(lignes for lignes, _ in morceaux_lus) // 2
+    lues, avant, apres = 0, [], []
+    for lignes, _ in morceaux_lus[1:-1]:
+        (avant if lues + lignes <= milieu else apres).append(lignes)
+        lues += lignes
+    if avant and apres:
+        assert min(apres) < max(avant)
+
+@pytest.mark.parametrize("nb_lignes", [5, LIGNES_SONDE])
+def test_filtrer_csv_ne_leve_pas_apres_la_derniere_ligne(tmp_path, monkeypatch, nb_lignes):
+    chemin = tmp_path / "court.csv"
+    pd.read_csv(FICHIER_CSV, nrows=nb_lignes).to_csv(chemin, index=False)
+
+    def plus_de_place(*args):
+        raise BudgetMemoireDepasse("plus de place")
+
+    monkeypatch.setattr(ingestion_commun, "calculer_taille_chunk", plus_de_place)
+    with open(chemin, "rb") as flux:
+        df_filtre = filtrer_csv_par_chunks(flux, DATE_CIBLE, parser_budget_memoire("1M"))
+
+    assert len(df_filtre) == len(filtrer_sans_budget(chemin))
+
+def test_filtrer_csv_leve_s_il_reste_des_lignes_sans_place(tmp_path, monkeypatch):
+    chemin = tmp_path / "court.csv"
+    pd.read_csv(FICHIER_CSV, nrows=LIGNES_SONDE + 1).to_csv(chemin, index=False)
+
+    def plus_de_place(*args):
+        raise BudgetMemoireDepasse("plus de place")
+
+    monkeypatch.setattr(ingestion_commun, "calculer_taille_chunk", plus_de_place)
+    with open(chemin, "rb") as flux:
+        with pytest.raises(BudgetMemoireDepasse):
+            filtrer_csv_par_chunks(flux, DATE_CIBLE, parser_budget_memoire("1M"))
+
+@pytest.mark.parametrize("budget", ["20K", "50K"])
+def test_filtrer_csv_budget_impossible(morceaux_lus, budget):
+    budget_memoire = parser_budget_memoire(budget)
+    with open(FICHIER_CSV, "rb") as flux:
+        with pytest.raises(BudgetMemoireDepasse):
+            filtrer_csv_par_chunks(flux, DATE_CIBLE, budget_memoire)
+
+    # Échec après la sonde, sans avoir lu le fichier complet
+    assert morceaux_lus[0][0] == LIGNES_SONDE
+    assert sum(lignes for lignes, _ in morceaux_lus) < len(pd.read_csv(FICHIER_CSV))
@@ -0,0 +1,92 @@
+"""Le parsing de dags/ingestion_dag.py doit rester léger quel que soit le nombre de sources"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip("airflow")
+yaml = pytest.importorskip("yaml")
+
+FICHIER_DAG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dags", "ingestion_dag.py")
+
+# Temps maximum de parsing du fichier DAG (Airflow déjà importé, comme dans le scheduler)
+BUDGET_PARSING_SECONDES = 1.0
+MODULES_LOURDS = ("pandas", "psycopg2", "minio")
+
+# Le parsing est mesuré dans un interpréteur neuf pour que sys.modules reflète
+# uniquement ce que le fichier DAG importe
+SCRIPT_PARSING = textwrap.dedent("""
+    import importlib.util, json, os, sys, time
+    import airflow
+    from airflow.operators.python import PythonOperator
+    
+    # Airflow ajoute le dossier des DAGs au sys.path avant de les parser
+    sys.path.insert(0, os.path.dirname(sys.argv[1]))
+    
+    modules_avant = set(sys.modules)
+    debut = time.perf_counter()
+    spec = importlib.util.spec_from_file_location("ingestion_dag", sys.argv[1])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    duree = time.perf_counter() - debut
+    
+    print(json.dumps({
+        "duree": duree,
+        "dag_ids": sorted(nom for nom, valeur in vars(module).items() if isinstance(valeur, airflow.DAG)),
+        "modules_importes": sorted(set(sys.modules) - modules_avant),
+    }))
+""")
+
+def lancer_parsing(chemin_config, **variables):
+    # Ne pas hériter d'un budget par défaut de l'environnement de test
+    environnement = {nom: valeur for nom, valeur in os.environ.items() if nom != "INGESTION_MEMORY_BUDGET"}
+    environnement.update(INGESTION_SOURCES_CONFIG=str(chemin_config), **variables)
+    return subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", SCRIPT_PARSING, FICHIER_DAG],
+        env=environnement, capture_output=True, text=True,
+    )
+
+def parser_fichier_dag(chemin_config, **variables):
+    resultat = lancer_parsing(chemin_config, **variables)
+    assert resultat.returncode == 0, resultat.stderr
+    return json.loads(resultat.stdout.strip().splitlines()[-1])
+
+def ecrire_config(tmp_path, sources):
+    chemin_config = tmp_path / "sources.yaml"
+    chemin_config.write_text(yaml.safe_dump({"sources": sources}))
+    return chemin_config
+
+@pytest.mark.parametrize("nb_sources", [1, 10, 50])
+def test_parsing_sous_budget(tmp_path, nb_sources):
+    chemin_config = ecrire_config(tmp_path, [
+        {"id": f"source_{i}", "bucket": "folder-source", "prefix": f"source_{i}/", "schedule": "0 2 * * *"}
+        for i in range(nb_sources)
+    ])
+    
+    resultat = parser_fichier_dag(chemin_config)
+    
+    assert resultat["dag_ids"] == sorted(f"ingestion_source_{i}_minio_postgres" for i in range(nb_sources))
+    assert resultat["duree"] < BUDGET_PARSING_SECONDES, resultat["duree"]
+    assert not [m for m in resultat["modules_importes"] if m.split(".")[0] in MODULES_LOURDS]
+
+def test_memory_budget_invalide_ignore_seulement_sa_source(tmp_path):
+    chemin_config = ecrire_config(tmp_path, [
+        {"id": "valide", "bucket": "folder-source", "prefix": "a/", "memory_budget": "512M"},
+        {"id": "budget_invalide", "bucket": "folder-source", "prefix": "b/", "memory_budget": "beaucoup"},
+    ])
+    
+    resultat = parser_fichier_dag(chemin_config)
+    
+    assert resultat["dag_ids"] == ["ingestion_valide_minio_postgres"]
+
+def test_budget_par_defaut_invalide_fait_echouer_l_import(tmp_path):
+    chemin_config = ecrire_config(tmp_path, [{"id": "valide", "bucket": "folder-source", "prefix": "a/"}])
+    
+    resultat = lancer_parsing(chemin_config, INGESTION_MEMORY_BUDGET="beaucoup")
+    
+    assert resultat.returncode != 0
+    assert "INGESTION_MEMORY_BUDGET invalide" in resultat.stderr
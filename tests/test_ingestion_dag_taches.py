@@ -0,0 +1,147 @@
+"""Tâches du DAG d'ingestion avec budget mémoire (Minio et PostgreSQL simulés)"""
+
+import io
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("airflow")
+pd = pytest.importorskip("pandas")
+
+from airflow.exceptions import AirflowFailException  # noqa: E402
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RACINE, "dags"))
+
+import ingestion_dag  # noqa: E402
+
+FICHIER_CSV = os.path.join(RACINE, "fashion_store_sales.csv")
+DS = "2025-06-16"
+
+class ReponseMinio(io.BytesIO):
+    def release_conn(self):
+        pass
+
+class ObjetMinio:
+    object_name = "fashion_store_sales.csv"
+
+class MinioSimule:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket_exists(self, bucket):
+        return True
+
+    def list_objects(self, bucket, prefix, recursive):
+        return [ObjetMinio()]
+
+    def get_object(self, bucket, cle):
+        with open(FICHIER_CSV, "rb") as fichier:
+            return ReponseMinio(fichier.read())
+
+class CurseurSimule:
+    def __init__(self, requetes):
+        self.requetes = requetes
+
+    def execute(self, requete, parametres):
+        self.requetes.append((requete, parametres))
+
+    def close(self):
+        pass
+
+class ConnexionSimulee:
+    def __init__(self, requetes):
+        self.requetes = requetes
+
+    def cursor(self):
+        return CurseurSimule(self.requetes)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class TaskInstanceSimulee:
+    def __init__(self):
+        self.xcom = {}
+
+    def xcom_push(self, key, value):
+        self.xcom[key] = value
+
+    def xcom_pull(self, task_ids, key="return_value"):
+        return self.xcom.get(key)
+
+@pytest.fixture
+def requetes(monkeypatch):
+    """Remplacer minio et psycopg2 importés par les tâches; renvoie les requêtes exécutées"""
+    requetes = []
+    minio = types.ModuleType("minio")
+    minio.Minio = MinioSimule
+    psycopg2 = types.ModuleType("psycopg2")
+    psycopg2.Error = type("Error", (Exception,), {})
+    psycopg2.connect = lambda **kwargs: ConnexionSimulee(requetes)
+    monkeypatch.setitem(sys.modules, "minio", minio)
+    monkeypatch.setitem(sys.modules, "psycopg2", psycopg2)
+    return requetes
+
+def telecharger(task_instance, budget_memoire=None):
+    resultat = ingestion_dag.telecharger_et_filtrer_depuis_minio(
+        DS, "folder-source", "fashion_store_sales.csv",
+        budget_memoire=budget_memoire, task_instance=task_instance,
+    )
+    task_instance.xcom["return_value"] = resultat
+    return resultat
+
+def inserer(task_instance, budget_memoire=None):
+    return ingestion_dag.inserer_dans_postgresql(
+        DS, "public", budget_memoire=budget_memoire, task_instance=task_instance,
+    )
+
+def totaux_sales(requetes):
+    """total_amount envoyé pour chaque upsert dans sales: [(sale_id, total_amount)]"""
+    return [(parametres[0], parametres[5]) for requete, parametres in requetes
+            if "INSERT INTO sales" in requete]
+
+def test_budget_lecture_impossible_echoue_sans_retry(requetes):
+    with pytest.raises(AirflowFailException):
+        telecharger(TaskInstanceSimulee(), budget_memoire=20 * 1024)
+
+def test_budget_xcom_insuffisant_avant_envoi(requetes, monkeypatch):
+    # La lecture tient dans le budget, la sérialisation XCom estimée non
+    monkeypatch.setattr(ingestion_dag, "FACTEUR_XCOM", 100)
+    task_instance = TaskInstanceSimulee()
+
+    with pytest.raises(AirflowFailException, match="XCom"):
+        telecharger(task_instance, budget_memoire=1024 ** 2)
+    assert "df_filtre" not in task_instance.xcom
+
+def test_budget_decodage_xcom_insuffisant(requetes):
+    task_instance = TaskInstanceSimulee()
+    telecharger(task_instance)
+
+    with pytest.raises(AirflowFailException, match="décoder"):
+        inserer(task_instance, budget_memoire=300 * 1024)
+    assert requetes == []
+
+def test_ecriture_par_morceaux_identique_a_l_ecriture_sans_budget(requetes, monkeypatch):
+    task_instance = TaskInstanceSimulee()
+    telecharger(task_instance)
+    resultat_sans_budget = inserer(task_instance)
+    totaux_sans_budget = dict(totaux_sales(requetes))
+    requetes.clear()
+
+    # Budget assez serré pour découper l'écriture de la journée en plusieurs morceaux
+    monkeypatch.setattr(ingestion_dag, "FACTEUR_DECODAGE_JSON", 1)
+    resultat = inserer(task_instance, budget_memoire=150 * 1024)
+    totaux = totaux_sales(requetes)
+
+    assert resultat == resultat_sans_budget
+    assert len(totaux) > resultat["sales"], "l'écriture aurait dû être découpée"
+    # Une vente répartie sur plusieurs morceaux garde le total de la journée complète
+    assert all(total == totaux_sans_budget[sale_id] for sale_id, total in totaux)